@@ -1,18 +1,49 @@
 import os
-import json
+import re
+import shutil
 import subprocess
 import tempfile
+import threading
 import time
+import http.client
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import lru_cache, partial, wraps
 from flask import Flask, request, jsonify, Response, stream_with_context
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
+from flask_compress import Compress
 import logging
+import orjson
+from cachetools import TLRUCache, TTLCache
+import yt_dlp
+
+class OrjsonProvider(JSONProvider):
+    """Serialize jsonify() responses with orjson"""
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 CORS(app)
 
+# Compress JSON/HTML only; media streams are already compressed
+app.config['COMPRESS_MIMETYPES'] = ['application/json', 'text/html']
+app.config['COMPRESS_LEVEL'] = 6
+Compress(app)
+
 # Configuration
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# Public URL of this server (e.g. https://example.herokuapp.com); when unset,
+# stream links are built from each request's Host header
+BASE_URL = os.environ.get('BASE_URL', '').rstrip('/')
 
 # Disable SSL verification
 os.environ['PYTHONHTTPSVERIFY'] = '0'
@@ -21,118 +52,545 @@ os.environ['PYTHONHTTPSVERIFY'] = '0'
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# yt-dlp options (runs in-process, no CLI subprocess per request)
+YDL_BASE_OPTS = {
+    'nocheckcertificate': True,
+    'source_address': '0.0.0.0',  # force IPv4
+    'geo_bypass': True,
+    'quiet': True,
+    'no_warnings': True,
+    'socket_timeout': 15,
+    # Player JS / signature cache shared by every instance and kept on disk
+    'cachedir': os.environ.get('YDL_CACHE_DIR', os.path.join(BASE_DIR, '.yt-dlp-cache')),
+}
+
+MEDIA_FORMATS = {
+    'audio': 'bestaudio/best',
+    'm4a': 'bestaudio[ext=m4a]',
+    'video': 'best[ext=mp4]',
+}
+
+MEDIA_MIMETYPES = {
+    'audio': 'audio/mpeg',
+    'm4a': 'audio/mp4',
+    'video': 'video/mp4',
+}
+
+MEDIA_EXTENSIONS = {
+    'audio': 'mp3',
+    'm4a': 'm4a',
+    'video': 'mp4',
+}
+
+# watch?...v=, embed/, shorts/, live/ and v/ URLs on youtube.com or
+# youtube-nocookie.com (any subdomain) plus youtu.be/ links, anchored to
+# the start so other hosts don't match; compiled once at import
+YT_URL_RE = re.compile(
+    r'(?:https?://)?(?:[A-Za-z0-9-]+\.)*'
+    r'(?:youtube(?:-nocookie)?\.com/(?:watch\?(?:[^#]*&)?v=|embed/|shorts/|live/|v/)|youtu\.be/)'
+    r'([A-Za-z0-9_-]{11})(?![A-Za-z0-9_-])',
+    re.IGNORECASE
+)
+BARE_ID_RE = re.compile(r'[A-Za-z0-9_-]{11}\Z')
+
+# Extraction runs on a bounded pool so a burst of requests can't start an
+# unbounded number of yt-dlp extractors at once
+YDL_WORKERS = int(os.environ.get('YDL_WORKERS', 4))
+RESOLVE_TIMEOUT = 60  # seconds, including time spent queued
+ydl_executor = ThreadPoolExecutor(max_workers=YDL_WORKERS, thread_name_prefix='ydl')
+
+# Resolved once so each spawn execs ffmpeg directly instead of searching PATH
+FFMPEG_BIN = shutil.which('ffmpeg') or 'ffmpeg'
+
+# ffmpeg argv templates, built once: input args plus output args per mode
+FFMPEG_BASE_ARGS = (FFMPEG_BIN, '-hide_banner', '-nostdin', '-loglevel', 'error')
+
+def mp3_encoder_args():
+    """Prefer the much cheaper fixed-point libshine encoder when ffmpeg has it"""
+    try:
+        encoders = subprocess.run(
+            [*FFMPEG_BASE_ARGS, '-encoders'],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=10
+        ).stdout
+    except (OSError, subprocess.SubprocessError):
+        encoders = b''
+    
+    if b' libshine ' in encoders:
+        return ('-c:a', 'libshine', '-b:a', '192k')
+    return ('-c:a', 'libmp3lame', '-q:a', '2')
+
+FFMPEG_OUTPUT_ARGS = {
+    'mp3': (*mp3_encoder_args(), '-f', 'mp3', 'pipe:1'),
+}
+
+# Video (mp4) and native AAC audio (m4a) are already in the container the
+# client gets, so they are relayed straight from googlevideo instead of
+# being remuxed through ffmpeg
+RELAY_MEDIA_TYPES = ('video', 'm4a')
+UPSTREAM_TIMEOUT = 15  # seconds
+# googlevideo answers these once a signed URL has expired or been revoked
+UPSTREAM_GONE_CODES = (403, 404, 410)
+UPSTREAM_GONE_RE = re.compile(rb'(?:HTTP error|Server returned) (?:403|404|410)\b')
+STREAM_CHUNK_SIZE = 1024 * 1024  # 1MB chunks
+
+# Each open stream holds a request thread, and a transcode also its own
+# ffmpeg process; cap how many run at once so a traffic spike queues
+# briefly instead of exhausting dyno memory or the gunicorn threads that
+# /health and /info need
+MAX_STREAMS = int(os.environ.get('MAX_STREAMS', 8))
+STREAM_SLOT_TIMEOUT = 5  # seconds to wait for a free slot before a 503
+STREAM_RETRY_AFTER = 10  # seconds, sent as Retry-After with that 503
+stream_slots = threading.BoundedSemaphore(MAX_STREAMS)
+
+# video_id -> {'summary', 'fresh_until', 'refresh_at'} for /info; titles
+# and durations don't change, so they are kept for hours, and for a day
+# past that are served stale while a background refresh runs (TTLCache is
+# not thread-safe, hence the lock)
+INFO_CACHE_TTL = 6 * 3600
+INFO_STALE_TTL = 24 * 3600
+INFO_REFRESH_RETRY = 15 * 60  # seconds between refresh attempts of a stale entry
+INFO_STALE_MAX_AGE = 60  # seconds clients may cache a stale entry, so they pick up the refresh
+info_cache = TTLCache(maxsize=10000, ttl=INFO_STALE_TTL)
+info_cache_lock = threading.Lock()
+
+# (video_id, media_type) -> (direct googlevideo URL, HTTP headers to fetch it
+# with), kept until shortly before the URL's own expire= timestamp (5 hours
+# if it has none); None records that the video has no format for that type
+STREAM_URL_TTL = 5 * 3600
+STREAM_URL_EXPIRY_MARGIN = 300  # seconds
+
+def stream_url_ttu(key, stream, now):
+    """Expiry time of a cached stream, on the cache's monotonic clock"""
+    if stream is None:
+        return now + STREAM_URL_TTL
+    
+    expire = urllib.parse.parse_qs(urllib.parse.urlsplit(stream[0]).query).get('expire')
+    try:
+        lifetime = int(expire[0]) - time.time() - STREAM_URL_EXPIRY_MARGIN
+    except (TypeError, ValueError):
+        lifetime = STREAM_URL_TTL
+    return now + lifetime
+
+stream_url_cache = TLRUCache(maxsize=1024, ttu=stream_url_ttu)
+stream_url_cache_lock = threading.Lock()
+
+# video_ids whose thumbnail preflight succeeded, so /download pays for the
+# HEAD at most once a day per video
+known_videos = TTLCache(maxsize=10000, ttl=INFO_STALE_TTL)
+known_videos_lock = threading.Lock()
+
+# video_id -> Future of an extraction that is still running
+inflight = {}
+inflight_lock = threading.Lock()
+
+# YoutubeDL is not thread-safe, so each worker thread keeps its own instance.
+# Extraction only runs on the fixed extractor pool, so these instances (and
+# the keep-alive connections of their HTTP handlers) live for the whole
+# process instead of being rebuilt per request.
+_ydl_local = threading.local()
+
+# One extract_info call returns every format of a video, so audio, video and
+# /info requests share a single extraction and each picks its own format
+# with these selectors (compiled once from MEDIA_FORMATS)
+_selector_ydl = yt_dlp.YoutubeDL(YDL_BASE_OPTS)
+FORMAT_SELECTORS = {
+    media_type: _selector_ydl.build_format_selector(spec)
+    for media_type, spec in MEDIA_FORMATS.items()
+}
+
+def get_ydl():
+    """Get this thread's YoutubeDL instance"""
+    ydl = getattr(_ydl_local, 'ydl', None)
+    if ydl is None:
+        ydl = _ydl_local.ydl = yt_dlp.YoutubeDL(YDL_BASE_OPTS)
+    return ydl
+
+def base_url():
+    """Public base URL of this server for building stream links"""
+    return BASE_URL or request.host_url.rstrip('/')
+
+def make_conditional(response):
+    """Answer with a bodiless 304 when If-None-Match already has this response
+
+    flask-compress rewrites the ETag to "<hash>:<algorithm>" after the view
+    runs, so the client's tags are compared with that suffix stripped.
+    """
+    etag, _ = response.get_etag()
+    for tag in request.if_none_match.as_set():
+        if tag.split(':', 1)[0] == etag:
+            not_modified = Response(status=304)
+            not_modified.set_etag(tag)
+            not_modified.headers['Cache-Control'] = response.headers['Cache-Control']
+            return not_modified
+    return response
+
+@lru_cache(maxsize=4096)
 def get_video_id(url):
     """Extract video ID from URL"""
-    import re
-    
     url = url.strip()
     
     # Direct video ID
-    if len(url) == 11 and ' ' not in url and '/' not in url and '=' not in url:
+    if BARE_ID_RE.match(url):
         return url
     
-    patterns = [
-        r'youtube\.com/watch\?v=([^&]+)',
-        r'youtu\.be/([^?]+)',
-        r'youtube\.com/embed/([^?]+)',
-        r'youtube\.com/shorts/([^?]+)',
-        r'youtube\.com/v/([^?]+)'
-    ]
+    # None for anything that isn't a YouTube link, so callers reject it
+    # with a 400 instead of handing it to yt-dlp
+    match = YT_URL_RE.match(url)
+    return match.group(1) if match else None
+
+def video_exists(video_id):
+    """Preflight: YouTube serves no thumbnail (404) for IDs that don't exist
+
+    Videos already extracted or checked recently skip the HEAD request.
+    """
+    with known_videos_lock:
+        if video_id in known_videos:
+            return True
+    with stream_url_cache_lock:
+        if any((video_id, media_type) in stream_url_cache for media_type in MEDIA_FORMATS):
+            return True
+    with info_cache_lock:
+        if video_id in info_cache:
+            return True
+    
+    thumb_url = f"https://img.youtube.com/vi/{urllib.parse.quote(video_id, safe='')}/default.jpg"
+    try:
+        urllib.request.urlopen(urllib.request.Request(thumb_url, method='HEAD'), timeout=2).close()
+    except urllib.error.HTTPError as e:
+        return e.code != 404
+    except Exception:
+        return True  # Thumbnail host unreachable: don't block, let yt-dlp decide
+    
+    with known_videos_lock:
+        known_videos[video_id] = True
+    return True
+
+def select_stream(info, media_type):
+    """Pick the best format for a media type as (direct URL, HTTP headers)"""
+    formats = info.get('formats') or [info]
+    # The selector is called the way YoutubeDL.process_video_result calls it;
+    # tests/test_app.py pins the pick for each MEDIA_FORMATS entry in case
+    # a yt-dlp upgrade changes that context
+    selected = next(iter(FORMAT_SELECTORS[media_type]({
+        'formats': formats,
+        'has_merged_format': any('none' not in (f.get('acodec'), f.get('vcodec')) for f in formats),
+        'incomplete_formats': (all(f.get('vcodec') == 'none' for f in formats)
+                               or all(f.get('acodec') == 'none' for f in formats)),
+    })), None)
+    
+    stream_url = selected.get('url') if selected else None
+    if stream_url and stream_url.startswith('http'):
+        # yt-dlp fetches each format with its own headers (User-Agent etc.)
+        return stream_url, selected.get('http_headers') or {}
+    return None
+
+def extract_video_info(video_id):
+    """Fetch video info with yt-dlp and cache its stream URLs (runs on the extractor pool)"""
+    youtube_url = f"https://www.youtube.com/watch?v={video_id}"
+    
+    logger.info("Extracting video info for %s", video_id)
+    info = get_ydl().extract_info(youtube_url, download=False)
+    
+    # Format selection is cheap next to extraction, so resolve every media
+    # type now (misses included); later requests for this video skip
+    # yt-dlp entirely
+    streams = {media_type: select_stream(info, media_type) for media_type in MEDIA_FORMATS}
+    with stream_url_cache_lock:
+        for media_type, stream in streams.items():
+            stream_url_cache[video_id, media_type] = stream
+    return info
+
+def forget_stream_urls(video_id):
+    """Drop every cached stream URL of a video, e.g. after googlevideo rejected one"""
+    with stream_url_cache_lock:
+        for media_type in MEDIA_FORMATS:
+            stream_url_cache.pop((video_id, media_type), None)
+
+def forget_inflight(key, future):
+    """Drop a finished extraction from the in-flight map"""
+    with inflight_lock:
+        if inflight.get(key) is future:
+            del inflight[key]
+
+def submit_extraction(key, fn, *args):
+    """Run fn on the extractor pool, joining an in-flight call for the same key"""
+    with inflight_lock:
+        future = inflight.get(key)
+        started = future is None
+        if started:
+            future = inflight[key] = ydl_executor.submit(fn, *args)
+    
+    if started:
+        future.add_done_callback(lambda f: forget_inflight(key, f))
+    return future
+
+def cache_summary(video_id, info):
+    """Build the /info summary from extracted info and cache it"""
+    summary = {
+        'title': info.get('title'),
+        'duration': info.get('duration_string'),
+        'thumbnail': info.get('thumbnail'),
+        'formats': len(info.get('formats', [])),
+    }
+    with info_cache_lock:
+        fresh_until = time.monotonic() + INFO_CACHE_TTL
+        info_cache[video_id] = {'summary': summary, 'fresh_until': fresh_until, 'refresh_at': fresh_until}
+    return summary
+
+def refresh_summary(video_id, future):
+    """Store the result of a background refresh, keeping the stale entry on failure"""
+    if future.cancelled():
+        return
+    if future.exception() is not None:
+        logger.warning("Refreshing info for %s failed: %s", video_id, future.exception())
+        return
+    
+    info = future.result()
+    if info:
+        cache_summary(video_id, info)
+
+def get_video_summary(video_id):
+    """Get title/duration/thumbnail/format count, served from cache when fresh
+
+    Returns (summary, max_age), max_age being how long clients may cache
+    it; summary is None if the video couldn't be extracted. Raises
+    TimeoutError if the extraction doesn't finish in RESOLVE_TIMEOUT.
+    """
+    with info_cache_lock:
+        entry = info_cache.get(video_id)
+        now = time.monotonic()
+        stale = entry is not None and now >= entry['fresh_until']
+        refresh = entry is not None and now >= entry['refresh_at']
+        if refresh:
+            # Updated in place so the entry keeps its original expiry, and
+            # a failing refresh is only retried every INFO_REFRESH_RETRY
+            entry['refresh_at'] = time.monotonic() + INFO_REFRESH_RETRY
     
-    for pattern in patterns:
-        match = re.search(pattern, url)
-        if match:
-            return match.group(1)
+    if entry is not None:
+        if refresh:
+            # Stale: answer now and refresh in the background
+            future = submit_extraction(video_id, extract_video_info, video_id)
+            future.add_done_callback(lambda f: refresh_summary(video_id, f))
+        return entry['summary'], INFO_STALE_MAX_AGE if stale else INFO_CACHE_TTL
+    
+    try:
+        future = submit_extraction(video_id, extract_video_info, video_id)
+        info = future.result(timeout=RESOLVE_TIMEOUT)
+    except yt_dlp.utils.DownloadError:
+        info = None
     
-    if 'v=' in url:
-        return url.split('v=')[-1].split('&')[0]
+    if not info:
+        return None, 0
     
-    return url
+    return cache_summary(video_id, info), INFO_CACHE_TTL
 
-def get_stream_url(video_id, media_type):
-    """Get direct stream URL from YouTube"""
+def get_stream(video_id, media_type):
+    """Get the direct stream URL from YouTube, with the headers to fetch it with"""
     try:
-        youtube_url = f"https://www.youtube.com/watch?v={video_id}"
+        with stream_url_cache_lock:
+            cached = (video_id, media_type) in stream_url_cache
+            stream = stream_url_cache.get((video_id, media_type))
         
-        # Get stream URL using yt-dlp
-        cmd = [
-            'yt-dlp',
-            '--no-check-certificates',
-            '--force-ipv4',
-            '--geo-bypass',
-            '--get-url',
-            '--format', 'bestaudio/best' if media_type == 'audio' else 'best[ext=mp4]',
-            '--quiet',
-            '--no-warnings',
-            youtube_url
-        ]
+        if not cached:
+            logger.info("Getting stream URL for %s (%s)", video_id, media_type)
+            future = submit_extraction(video_id, extract_video_info, video_id)
+            stream = select_stream(future.result(timeout=RESOLVE_TIMEOUT), media_type)
         
-        logger.info(f"Getting stream URL for {video_id} ({media_type})")
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=30)
+        if stream:
+            logger.info("Got stream URL: %.100s...", stream[0])
+            return True, stream
         
-        if result.returncode == 0:
-            stream_url = result.stdout.strip()
-            if stream_url and stream_url.startswith('http'):
-                logger.info(f"Got stream URL: {stream_url[:100]}...")
-                return True, stream_url
-        
-        return False, result.stderr or "Failed to get stream URL"
+        return False, f"No {media_type} format available for this video"
         
+    except TimeoutError:
+        return False, "Timed out getting stream URL"
     except Exception as e:
         return False, str(e)
 
-def stream_youtube_data(video_id, media_type):
-    """Stream YouTube data directly to client"""
+def log_ffmpeg_errors(stderr, upstream_gone):
+    """Forward ffmpeg stderr to the log line by line, flagging rejected URLs"""
+    with stderr:
+        for line in iter(stderr.readline, b''):
+            logger.warning("ffmpeg: %s", line.decode(errors='replace').rstrip())
+            if UPSTREAM_GONE_RE.search(line):
+                upstream_gone.set()
+
+def run_ffmpeg(stream, output):
+    """Run ffmpeg on a stream URL and yield its stdout in chunks
+
+    Returns True if googlevideo rejected the URL before any output was sent.
+    """
+    stream_url, http_headers = stream
+    ffmpeg_cmd = [*FFMPEG_BASE_ARGS]
+    if http_headers:
+        ffmpeg_cmd += ['-headers', ''.join(f"{name}: {value}\r\n" for name, value in http_headers.items())]
+    ffmpeg_cmd += ['-i', stream_url, *FFMPEG_OUTPUT_ARGS[output]]
+    
+    # Unbuffered: chunks are read straight off the pipe instead of
+    # being staged through a userspace buffer first
+    process = subprocess.Popen(
+        ffmpeg_cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        bufsize=0
+    )
+    
+    # Drain stderr as it arrives so errors show up in the log right away
+    # and a full pipe can never stall ffmpeg
+    upstream_gone = threading.Event()
+    stderr_thread = threading.Thread(
+        target=log_ffmpeg_errors, args=(process.stderr, upstream_gone), daemon=True
+    )
+    stderr_thread.start()
+    
+    # Stream data in chunks
+    sent = False
     try:
-        # Get stream URL
-        success, stream_url = get_stream_url(video_id, media_type)
-        
-        if not success:
-            yield json.dumps({'error': stream_url}).encode()
-            return
+        while True:
+            chunk = process.stdout.read(STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            sent = True
+            yield chunk
+            
+    finally:
+        # Cleanup
+        try:
+            process.terminate()
+            process.wait(timeout=5)
+        except:
+            process.kill()
+    
+    stderr_thread.join(timeout=5)
+    return not sent and upstream_gone.is_set()
+
+def pipe_ffmpeg(video_id, media_type, stream, output):
+    """Stream a transcode of the media
+
+    A cached URL that googlevideo no longer accepts is dropped and
+    re-resolved once.
+    """
+    if (yield from run_ffmpeg(stream, output)):
+        logger.info("Stream URL for %s was rejected, resolving again", video_id)
+        forget_stream_urls(video_id)
+        success, stream = get_stream(video_id, media_type)
+        if success:
+            yield from run_ffmpeg(stream, output)
+
+def holds_stream_slot(build_response):
+    """Hold a stream slot from before the response is built until it closes
+
+    The slot is taken first, so a saturated server answers with a real 503
+    instead of a media body holding a JSON error. Error tuples release it
+    right away; responses must not be direct_passthrough, since werkzeug
+    skips call_on_close callbacks for those.
+    """
+    @wraps(build_response)
+    def wrapper(*args):
+        if not stream_slots.acquire(timeout=STREAM_SLOT_TIMEOUT):
+            logger.warning("All stream slots busy, rejecting stream")
+            return (jsonify({'error': 'Server busy, try again later'}), 503,
+                    {'Retry-After': str(STREAM_RETRY_AFTER)})
         
-        # Use ffmpeg to stream directly
-        ffmpeg_cmd = [
-            'ffmpeg',
-            '-i', stream_url,
-            '-c', 'copy',
-            '-f', 'mp3' if media_type == 'audio' else 'mp4',
-            'pipe:1'
-        ]
+        try:
+            response = build_response(*args)
+        except BaseException:
+            stream_slots.release()
+            raise
         
-        # Start ffmpeg process
-        process = subprocess.Popen(
-            ffmpeg_cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            bufsize=10**8
-        )
+        if isinstance(response, tuple):
+            stream_slots.release()
+        else:
+            response.call_on_close(stream_slots.release)
+        return response
+    
+    return wrapper
+
+@holds_stream_slot
+def transcode_response(video_id, media_type, headers):
+    """Transcode the media to mp3"""
+    success, stream = get_stream(video_id, media_type)
+    if not success:
+        return jsonify({'error': stream}), 500
+    
+    return Response(
+        stream_with_context(pipe_ffmpeg(video_id, media_type, stream, 'mp3')),
+        headers=headers
+    )
+
+# googlevideo URLs are signed for the IP that resolved them (ip=), so the
+# relay has to connect the same way extraction did
+UPSTREAM_SOURCE = (YDL_BASE_OPTS['source_address'], 0)
+
+class IPv4HTTPHandler(urllib.request.HTTPHandler):
+    """Connect from IPv4 only, matching YDL_BASE_OPTS['source_address']"""
+    
+    def http_open(self, req):
+        return self.do_open(partial(http.client.HTTPConnection, source_address=UPSTREAM_SOURCE), req)
+
+class IPv4HTTPSHandler(urllib.request.HTTPSHandler):
+    """Connect from IPv4 only, matching YDL_BASE_OPTS['source_address']"""
+    
+    def https_open(self, req):
+        return self.do_open(partial(http.client.HTTPSConnection, source_address=UPSTREAM_SOURCE),
+                            req, context=self._context)
+
+upstream_opener = urllib.request.build_opener(IPv4HTTPHandler, IPv4HTTPSHandler)
+
+def relay_upstream(upstream):
+    """Yield an upstream googlevideo response body as it arrives"""
+    with upstream:
+        while True:
+            chunk = upstream.read1(STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+@holds_stream_slot
+def relay_response(video_id, media_type, headers):
+    """Relay the source media as-is, without spawning ffmpeg"""
+    for attempt in range(2):
+        success, stream = get_stream(video_id, media_type)
+        if not success:
+            return jsonify({'error': stream}), 500
         
-        # Stream data in chunks
-        chunk_size = 1024 * 1024  # 1MB chunks
+        # Forward Range so seeking fetches only the requested bytes from
+        # googlevideo and the client gets a real 206 back
+        stream_url, http_headers = stream
+        upstream_request = urllib.request.Request(stream_url, headers=http_headers)
+        range_header = request.headers.get('Range')
+        if range_header:
+            upstream_request.add_header('Range', range_header)
         
         try:
-            while True:
-                chunk = process.stdout.read(chunk_size)
-                if not chunk:
-                    break
-                yield chunk
-                
-                # Check if process is still alive
-                if process.poll() is not None:
-                    break
-                    
-        finally:
-            # Cleanup
-            try:
-                process.terminate()
-                process.wait(timeout=5)
-            except:
-                process.kill()
-                
-    except Exception as e:
-        logger.error(f"Stream error: {str(e)}")
-        yield json.dumps({'error': str(e)}).encode()
+            upstream = upstream_opener.open(upstream_request, timeout=UPSTREAM_TIMEOUT)
+            break
+        except urllib.error.HTTPError as e:
+            e.close()
+            if e.code == 416:
+                return Response(status=416, headers={'Content-Range': e.headers.get('Content-Range', '')})
+            if e.code not in UPSTREAM_GONE_CODES or attempt:
+                raise
+            
+            # The cached URL expired or was revoked: resolve it again once
+            logger.info("Stream URL for %s was rejected (%s), resolving again", video_id, e.code)
+            forget_stream_urls(video_id)
+    
+    if upstream.headers.get('Content-Length'):
+        headers.pop('Transfer-Encoding', None)
+    for name in ('Content-Length', 'Content-Range'):
+        if upstream.headers.get(name):
+            headers[name] = upstream.headers[name]
+    headers['Accept-Ranges'] = 'bytes'
+    
+    response = Response(
+        relay_upstream(upstream),
+        status=upstream.status,
+        headers=headers
+    )
+    # HEAD requests and aborted responses never start relay_upstream
+    response.call_on_close(upstream.close)
+    return response
 
 # ============== STREAM ENDPOINTS ==============
 
@@ -144,6 +602,7 @@ def stream_direct():
     Parameters:
         url: YouTube URL or Video ID
         type: "audio" or "video"
+        codec: "mp3" (default) or "m4a" to get audio without transcoding
     
     Returns:
         Direct stream of the media
@@ -158,38 +617,50 @@ def stream_direct():
         if media_type not in ['audio', 'video']:
             return jsonify({'error': 'Invalid type'}), 400
         
+        codec = request.args.get('codec', 'mp3').strip().lower()
+        if codec not in ['mp3', 'm4a']:
+            return jsonify({'error': 'Invalid codec'}), 400
+        if media_type == 'audio' and codec == 'm4a':
+            media_type = 'm4a'
+        
         video_id = get_video_id(video_url)
         if not video_id:
             return jsonify({'error': 'Invalid YouTube URL'}), 400
         
-        logger.info(f"Direct stream request: {video_id} ({media_type})")
-        
-        # Set appropriate headers
-        headers = {
-            'Content-Type': 'audio/mpeg' if media_type == 'audio' else 'video/mp4',
-            'Transfer-Encoding': 'chunked',
-            'Cache-Control': 'no-cache, no-store, must-revalidate',
-            'Pragma': 'no-cache',
-            'Expires': '0',
-            'Accept-Ranges': 'bytes'
-        }
-        
-        # Add Content-Disposition for download
-        if request.args.get('download'):
-            filename = f"{video_id}.{'mp3' if media_type == 'audio' else 'mp4'}"
-            headers['Content-Disposition'] = f'attachment; filename="{filename}"'
-        
-        # Stream the response
-        return Response(
-            stream_with_context(stream_youtube_data(video_id, media_type)),
-            headers=headers,
-            direct_passthrough=True
-        )
+        logger.info("Direct stream request: %s (%s)", video_id, media_type)
+        return stream_media(video_id, media_type)
         
     except Exception as e:
-        logger.error(f"Stream endpoint error: {str(e)}")
+        logger.error("Stream endpoint error: %s", e)
         return jsonify({'error': str(e)}), 500
 
+def stream_media(video_id, media_type):
+    """Relay or transcode a media type, with the /stream response headers"""
+    # Set appropriate headers
+    headers = {
+        'Content-Type': MEDIA_MIMETYPES[media_type],
+        'Transfer-Encoding': 'chunked',
+        'Cache-Control': 'no-cache, no-store, must-revalidate',
+        'Pragma': 'no-cache',
+        'Expires': '0',
+        # Piped ffmpeg output cannot be seeked, so don't invite Range
+        # requests that would each restart the transcode from byte 0
+        # (relayed video overrides this with real Range support)
+        'Accept-Ranges': 'none'
+    }
+    
+    # Add Content-Disposition for download
+    if request.args.get('download'):
+        filename = f"{video_id}.{MEDIA_EXTENSIONS[media_type]}"
+        headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    
+    if media_type in RELAY_MEDIA_TYPES:
+        return relay_response(video_id, media_type, headers)
+    
+    # YouTube audio is AAC/Opus, which can't be stream-copied into
+    # an mp3 container, so it is transcoded
+    return transcode_response(video_id, media_type, headers)
+
 @app.route('/stream/audio', methods=['GET'])
 def stream_audio():
     """Stream audio only"""
@@ -206,7 +677,16 @@ def stream_video():
     if not video_url:
         return jsonify({'error': 'Missing URL'}), 400
     
-    return stream_direct()
+    video_id = get_video_id(video_url)
+    if not video_id:
+        return jsonify({'error': 'Invalid YouTube URL'}), 400
+    
+    # stream_direct() would read type from the query, which defaults to audio
+    try:
+        return stream_media(video_id, 'video')
+    except Exception as e:
+        logger.error("Stream endpoint error: %s", e)
+        return jsonify({'error': str(e)}), 500
 
 @app.route('/stream/mp3', methods=['GET'])
 def stream_mp3():
@@ -221,61 +701,13 @@ def stream_mp3():
     
     # Convert to MP3 while streaming
     try:
-        youtube_url = f"https://www.youtube.com/watch?v={video_id}"
-        
-        # Get audio stream URL
-        cmd = [
-            'yt-dlp',
-            '--no-check-certificates',
-            '--get-url',
-            '--format', 'bestaudio',
-            '--quiet',
-            youtube_url
-        ]
-        
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=30)
-        
-        if result.returncode != 0:
-            return jsonify({'error': 'Failed to get audio stream'}), 500
-        
-        stream_url = result.stdout.strip()
-        
-        # Stream with ffmpeg conversion to MP3
-        def generate():
-            ffmpeg_cmd = [
-                'ffmpeg',
-                '-i', stream_url,
-                '-c:a', 'libmp3lame',
-                '-q:a', '2',
-                '-f', 'mp3',
-                'pipe:1'
-            ]
-            
-            process = subprocess.Popen(
-                ffmpeg_cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE
-            )
-            
-            try:
-                while True:
-                    chunk = process.stdout.read(1024 * 1024)  # 1MB chunks
-                    if not chunk:
-                        break
-                    yield chunk
-            finally:
-                process.terminate()
-        
         headers = {
             'Content-Type': 'audio/mpeg',
             'Content-Disposition': f'attachment; filename="{video_id}.mp3"',
             'Cache-Control': 'no-cache'
         }
         
-        return Response(
-            stream_with_context(generate()),
-            headers=headers
-        )
+        return transcode_response(video_id, 'audio', headers)
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -293,60 +725,13 @@ def stream_mp4():
     
     # Stream as MP4
     try:
-        youtube_url = f"https://www.youtube.com/watch?v={video_id}"
-        
-        # Get video stream URL
-        cmd = [
-            'yt-dlp',
-            '--no-check-certificates',
-            '--get-url',
-            '--format', 'best[ext=mp4]',
-            '--quiet',
-            youtube_url
-        ]
-        
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=30)
-        
-        if result.returncode != 0:
-            return jsonify({'error': 'Failed to get video stream'}), 500
-        
-        stream_url = result.stdout.strip()
-        
-        # Stream directly
-        def generate():
-            ffmpeg_cmd = [
-                'ffmpeg',
-                '-i', stream_url,
-                '-c', 'copy',
-                '-f', 'mp4',
-                'pipe:1'
-            ]
-            
-            process = subprocess.Popen(
-                ffmpeg_cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE
-            )
-            
-            try:
-                while True:
-                    chunk = process.stdout.read(1024 * 1024)
-                    if not chunk:
-                        break
-                    yield chunk
-            finally:
-                process.terminate()
-        
         headers = {
             'Content-Type': 'video/mp4',
             'Content-Disposition': f'attachment; filename="{video_id}.mp4"',
             'Cache-Control': 'no-cache'
         }
         
-        return Response(
-            stream_with_context(generate()),
-            headers=headers
-        )
+        return relay_response(video_id, 'video', headers)
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -370,11 +755,19 @@ def download_compat():
             return jsonify({'error': 'Invalid type'}), 400
         
         video_id = get_video_id(video_url)
-        if not video_id:
+        if not video_id or not video_exists(video_id):
             return jsonify({'error': 'Invalid YouTube URL'}), 400
         
+        # Start extracting now, so the client's follow-up /stream call
+        # joins the running extraction instead of starting one (unless
+        # its stream URL is already cached and /stream won't extract)
+        with stream_url_cache_lock:
+            cached = (video_id, media_type) in stream_url_cache
+        if not cached:
+            submit_extraction(video_id, extract_video_info, video_id)
+        
         # Return stream URL
-        stream_url = f"{request.host_url.rstrip('/')}/stream?url={video_id}&type={media_type}"
+        stream_url = f"{base_url()}/stream?url={video_id}&type={media_type}"
         
         # Check client for response format
         user_agent = request.headers.get('User-Agent', '').lower()
@@ -397,6 +790,15 @@ def download_compat():
 
 # ============== UTILITY ENDPOINTS ==============
 
+HEALTH_ENDPOINTS = {
+    'stream': '/stream?url=VIDEO_ID&type=audio|video&codec=mp3|m4a',
+    'stream_audio': '/stream/audio?url=VIDEO_ID',
+    'stream_video': '/stream/video?url=VIDEO_ID',
+    'stream_mp3': '/stream/mp3?url=VIDEO_ID',
+    'stream_mp4': '/stream/mp4?url=VIDEO_ID',
+    'download_compat': '/download?url=VIDEO_ID&type=audio|video'
+}
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check"""
@@ -405,51 +807,42 @@ def health_check():
         'service': 'YouTube Stream-Only API',
         'timestamp': datetime.now().isoformat(),
         'mode': 'stream-only',
-        'endpoints': {
-            'stream': '/stream?url=VIDEO_ID&type=audio|video',
-            'stream_audio': '/stream/audio?url=VIDEO_ID',
-            'stream_video': '/stream/video?url=VIDEO_ID',
-            'stream_mp3': '/stream/mp3?url=VIDEO_ID',
-            'stream_mp4': '/stream/mp4?url=VIDEO_ID',
-            'download_compat': '/download?url=VIDEO_ID&type=audio|video'
-        }
+        'endpoints': HEALTH_ENDPOINTS
     })
 
 @app.route('/info/<video_id>', methods=['GET'])
 def video_info(video_id):
     """Get video information"""
+    if not BARE_ID_RE.match(video_id):
+        return jsonify({'error': 'Invalid video ID'}), 400
+    
     try:
-        youtube_url = f"https://www.youtube.com/watch?v={video_id}"
+        summary, max_age = get_video_summary(video_id)
         
-        cmd = [
-            'yt-dlp',
-            '--no-check-certificates',
-            '--dump-json',
-            '--quiet',
-            youtube_url
-        ]
-        
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=30)
-        
-        if result.returncode == 0:
-            info = json.loads(result.stdout)
-            return jsonify({
+        if summary:
+            base = base_url()
+            response = jsonify({
                 'status': 'success',
                 'video_id': video_id,
-                'title': info.get('title'),
-                'duration': info.get('duration_string'),
-                'thumbnail': info.get('thumbnail'),
-                'formats': len(info.get('formats', [])),
+                **summary,
                 'stream_urls': {
-                    'audio': f"{request.host_url.rstrip('/')}/stream/audio?url={video_id}",
-                    'video': f"{request.host_url.rstrip('/')}/stream/video?url={video_id}",
-                    'mp3': f"{request.host_url.rstrip('/')}/stream/mp3?url={video_id}",
-                    'mp4': f"{request.host_url.rstrip('/')}/stream/mp4?url={video_id}"
+                    'audio': f"{base}/stream/audio?url={video_id}",
+                    'video': f"{base}/stream/video?url={video_id}",
+                    'mp3': f"{base}/stream/mp3?url={video_id}",
+                    'mp4': f"{base}/stream/mp4?url={video_id}"
                 }
             })
+            response.cache_control.public = True
+            response.cache_control.max_age = max_age
+            
+            # Revalidating clients get a bodiless 304 when nothing changed
+            response.add_etag()
+            return make_conditional(response)
         else:
             return jsonify({'error': 'Failed to get video info'}), 500
             
+    except TimeoutError:
+        return jsonify({'error': 'Timed out getting video info'}), 504
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -498,8 +891,9 @@ def test_stream():
     </html>
     '''
 
+# Local development only; production runs under gunicorn (see Procfile)
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
-    logger.info(f"🎵 Stream-Only YouTube API starting on port {port}")
+    logger.info("🎵 Stream-Only YouTube API starting on port %s", port)
     logger.info("📡 Streaming directly from YouTube (no files saved)")
     app.run(host='0.0.0.0', port=port, debug=False)
@@ -0,0 +1,345 @@
+import http.server
+import sys
+import threading
+import time
+
+import pytest
+
+import app
+
+
+def wait_for_extractions():
+    """Block until every background extraction has finished and been forgotten"""
+    while True:
+        with app.inflight_lock:
+            if not app.inflight:
+                return
+        time.sleep(0.01)
+
+
+class FakeYDL:
+    """Stands in for the extractor threads' YoutubeDL instances"""
+    
+    def __init__(self, extract_info):
+        self.extract_info = extract_info
+
+
+@pytest.fixture
+def client():
+    return app.app.test_client()
+
+
+def test_info_revalidates_compressed_response(client):
+    app.cache_summary('dQw4w9WgXcQ', {
+        'title': 'A title long enough to push the body past the compression threshold ' * 10,
+        'duration_string': '3:33',
+        'thumbnail': 'https://i.ytimg.com/vi/dQw4w9WgXcQ/default.jpg',
+        'formats': [],
+    })
+    headers = {'Host': 'api.example.com', 'Accept-Encoding': 'br'}
+    
+    first = client.get('/info/dQw4w9WgXcQ', headers=headers)
+    assert first.status_code == 200
+    assert first.headers['Content-Encoding'] == 'br'
+    etag = first.headers['ETag']
+    assert etag.endswith(':br"')
+    
+    second = client.get('/info/dQw4w9WgXcQ', headers={**headers, 'If-None-Match': etag})
+    assert second.status_code == 304
+    assert second.data == b''
+    assert second.headers['ETag'] == etag
+
+
+def test_stale_info_refresh_is_not_retried_on_every_request(monkeypatch):
+    app.cache_summary('oHg5SJYRHA0', {'title': 'Old title', 'formats': []})
+    app.info_cache['oHg5SJYRHA0'].update(fresh_until=0, refresh_at=0)
+    
+    extractions = []
+    
+    def failing_extraction(video_id):
+        extractions.append(video_id)
+        raise app.yt_dlp.utils.DownloadError('Video unavailable')
+    
+    monkeypatch.setattr(app, 'extract_video_info', failing_extraction)
+    for _ in range(5):
+        summary, max_age = app.get_video_summary('oHg5SJYRHA0')
+        assert summary['title'] == 'Old title'
+        wait_for_extractions()
+    
+    assert extractions == ['oHg5SJYRHA0']
+
+
+def test_stale_info_gets_short_max_age(client, monkeypatch):
+    app.cache_summary('ZZ5LpwO-An4', {'title': 'Old title', 'formats': []})
+    app.info_cache['ZZ5LpwO-An4'].update(fresh_until=0, refresh_at=0)
+    monkeypatch.setattr(app, 'extract_video_info', lambda video_id: None)
+    
+    response = client.get('/info/ZZ5LpwO-An4')
+    wait_for_extractions()
+    
+    assert response.status_code == 200
+    assert response.cache_control.max_age == app.INFO_STALE_MAX_AGE
+
+
+def test_info_times_out_with_504(client, monkeypatch):
+    release = threading.Event()
+    monkeypatch.setattr(app, 'RESOLVE_TIMEOUT', 0.05)
+    monkeypatch.setattr(app, 'extract_video_info', lambda video_id: release.wait(5))
+    try:
+        response = client.get('/info/9bZkp7q19f0')
+    finally:
+        release.set()
+        wait_for_extractions()
+    
+    assert response.status_code == 504
+    assert response.json == {'error': 'Timed out getting video info'}
+
+
+@pytest.mark.parametrize('url', [
+    'dQw4w9WgXcQ',
+    'https://www.youtube.com/watch?v=dQw4w9WgXcQ',
+    'https://www.youtube.com/watch?feature=share&v=dQw4w9WgXcQ&t=42',
+    'https://m.youtube.com/watch?v=dQw4w9WgXcQ',
+    'https://music.youtube.com/watch?v=dQw4w9WgXcQ&list=RDdQw4w9WgXcQ',
+    'youtube.com/embed/dQw4w9WgXcQ',
+    'https://www.youtube-nocookie.com/embed/dQw4w9WgXcQ',
+    'https://www.youtube.com/shorts/dQw4w9WgXcQ?si=abc',
+    'https://www.youtube.com/live/dQw4w9WgXcQ',
+    'https://www.youtube.com/v/dQw4w9WgXcQ',
+    'https://youtu.be/dQw4w9WgXcQ?t=10',
+    '  https://youtu.be/dQw4w9WgXcQ  ',
+])
+def test_get_video_id_accepts_youtube_links(url):
+    assert app.get_video_id(url) == 'dQw4w9WgXcQ'
+
+
+@pytest.mark.parametrize('url', [
+    'not a video',
+    'https://example.com/?v=dQw4w9WgXcQ',
+    'https://evil.com/embed/dQw4w9WgXcQ',
+    'https://notyoutube.com/watch?v=dQw4w9WgXcQ',
+    'https://youtube.com.evil.com/watch?v=dQw4w9WgXcQ',
+    'https://evil.com/?next=https://youtu.be/dQw4w9WgXcQ',
+    'https://www.youtube.com/watch?v=dQw4w9WgXcQxyz',
+])
+def test_get_video_id_rejects_other_input(url):
+    assert app.get_video_id(url) is None
+
+
+def test_info_rejects_invalid_video_id(client):
+    response = client.get('/info/not-a-video-id-at-all')
+    assert response.status_code == 400
+    assert 'not-a-video-id-at-all' not in app.info_cache
+
+
+# A typical video's formats in yt-dlp's order, worst to best
+FORMATS = [
+    {'format_id': '18', 'ext': 'mp4', 'acodec': 'mp4a.40.2', 'vcodec': 'avc1.42001E',
+     'url': 'https://media.example/18'},
+    {'format_id': '140', 'ext': 'm4a', 'acodec': 'mp4a.40.2', 'vcodec': 'none',
+     'url': 'https://media.example/140'},
+    {'format_id': '251', 'ext': 'webm', 'acodec': 'opus', 'vcodec': 'none',
+     'url': 'https://media.example/251'},
+]
+
+
+PICKS = {'audio': '251', 'm4a': '140', 'video': '18'}
+
+
+def test_every_media_format_is_pinned():
+    assert set(PICKS) == set(app.MEDIA_FORMATS)
+
+
+@pytest.mark.parametrize('media_type, format_id', PICKS.items())
+def test_select_stream_picks_format(media_type, format_id):
+    url, headers = app.select_stream({'formats': FORMATS}, media_type)
+    assert url == f'https://media.example/{format_id}'
+
+
+def test_missing_m4a_format_is_cached(client, monkeypatch):
+    extractions = []
+    
+    def extract_info(url, download):
+        extractions.append(url)
+        return {'formats': [
+            {'format_id': '251', 'url': 'https://rr1.googlevideo.com/251', 'ext': 'webm',
+             'acodec': 'opus', 'vcodec': 'none'},
+        ]}
+    
+    monkeypatch.setattr(app, 'get_ydl', lambda: FakeYDL(extract_info))
+    for _ in range(3):
+        response = client.get('/stream?url=jNQXAC9IVRw&type=audio&codec=m4a')
+        assert response.status_code == 500
+        assert response.json == {'error': 'No m4a format available for this video'}
+    
+    assert len(extractions) == 1
+
+
+@pytest.fixture
+def upstream():
+    """Local stand-in for googlevideo that records each request it gets"""
+    seen = []
+    
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            seen.append({'path': self.path, 'headers': dict(self.headers)})
+            status = 403 if self.path.startswith('/expired') else 200
+            self.send_response(status)
+            self.send_header('Content-Length', '4' if status == 200 else '0')
+            self.end_headers()
+            if status == 200:
+                self.wfile.write(b'mp4!')
+        
+        def log_message(self, *args):
+            pass
+    
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_port}', seen
+    server.shutdown()
+
+
+def test_relay_sends_format_headers_upstream(client, upstream):
+    base, seen = upstream
+    app.stream_url_cache['M7lc1UVf-VE', 'video'] = (f'{base}/videoplayback', {'User-Agent': 'yt-dlp-agent'})
+    
+    response = client.get('/stream?url=M7lc1UVf-VE&type=video')
+    
+    assert response.status_code == 200
+    assert response.data == b'mp4!'
+    assert seen[0]['headers']['User-Agent'] == 'yt-dlp-agent'
+
+
+def test_stream_video_route_relays_video(client, upstream):
+    base, seen = upstream
+    app.stream_url_cache['9bZkp7q19f0', 'video'] = (f'{base}/videoplayback', {})
+    
+    response = client.get('/stream/video?url=9bZkp7q19f0')
+    
+    assert response.status_code == 200
+    assert response.mimetype == 'video/mp4'
+    assert response.data == b'mp4!'
+    assert [request['path'] for request in seen] == ['/videoplayback']
+
+def test_relay_head_closes_upstream(client, upstream, monkeypatch):
+    base, seen = upstream
+    app.stream_url_cache['kffacxfA7G4', 'video'] = (f'{base}/videoplayback', {})
+    monkeypatch.setattr(app, 'stream_slots', threading.BoundedSemaphore(1))
+    opened = []
+    
+    def open_upstream(req, timeout):
+        opened.append(app.urllib.request.OpenerDirector.open(app.upstream_opener, req, timeout=timeout))
+        return opened[-1]
+    
+    monkeypatch.setattr(app.upstream_opener, 'open', open_upstream)
+    response = client.head('/stream?url=kffacxfA7G4&type=video')
+    response.close()
+    
+    assert response.status_code == 200
+    assert opened[0].closed
+    assert app.stream_slots.acquire(blocking=False)
+
+
+def test_relay_returns_503_when_all_slots_are_busy(client, upstream, monkeypatch):
+    base, seen = upstream
+    app.stream_url_cache['kffacxfA7G4', 'video'] = (f'{base}/videoplayback', {})
+    slots = threading.BoundedSemaphore(1)
+    slots.acquire()
+    monkeypatch.setattr(app, 'stream_slots', slots)
+    monkeypatch.setattr(app, 'STREAM_SLOT_TIMEOUT', 0.01)
+    
+    response = client.get('/stream/mp4?url=kffacxfA7G4')
+    
+    assert response.status_code == 503
+    assert seen == []
+
+def test_relay_reresolves_rejected_stream_url(client, upstream, monkeypatch):
+    base, seen = upstream
+    app.stream_url_cache['ScMzIvxBSi4', 'video'] = (f'{base}/expired', {})
+    extractions = []
+    
+    def extract_info(url, download):
+        extractions.append(url)
+        return {'formats': [
+            {'format_id': '18', 'url': f'{base}/fresh', 'ext': 'mp4',
+             'acodec': 'mp4a.40.2', 'vcodec': 'avc1.42001E'},
+        ]}
+    
+    monkeypatch.setattr(app, 'get_ydl', lambda: FakeYDL(extract_info))
+    for _ in range(3):
+        response = client.get('/stream?url=ScMzIvxBSi4&type=video')
+        assert response.status_code == 200
+        assert response.data == b'mp4!'
+    
+    assert len(extractions) == 1
+    assert [request['path'] for request in seen] == ['/expired', '/fresh', '/fresh', '/fresh']
+
+
+def test_download_preflight_is_cached(client, monkeypatch):
+    heads = []
+    
+    class Thumbnail:
+        def close(self):
+            pass
+    
+    def urlopen(req, timeout):
+        heads.append(req.full_url)
+        return Thumbnail()
+    
+    monkeypatch.setattr(app.urllib.request, 'urlopen', urlopen)
+    monkeypatch.setattr(app, 'get_ydl', lambda: FakeYDL(lambda url, download: {'formats': []}))
+    app.cache_summary('kJQP7kiw5Fk', {'title': 'Already extracted', 'formats': []})
+    
+    for video_id in ('y6120QOlsfU', 'y6120QOlsfU', 'kJQP7kiw5Fk'):
+        assert client.get(f'/download?url={video_id}').status_code == 200
+    wait_for_extractions()
+    
+    assert heads == ['https://img.youtube.com/vi/y6120QOlsfU/default.jpg']
+
+
+def test_download_skips_prefetch_of_cached_stream(client, monkeypatch):
+    extractions = []
+    
+    def extract_info(url, download):
+        extractions.append(url)
+        return {'formats': []}
+    
+    monkeypatch.setattr(app, 'get_ydl', lambda: FakeYDL(extract_info))
+    with app.stream_url_cache_lock:
+        app.stream_url_cache['hT_nvWreIhg', 'video'] = ('https://media.example/18', {})
+    
+    for _ in range(3):
+        assert client.get('/download?url=hT_nvWreIhg&type=video').status_code == 200
+    wait_for_extractions()
+    
+    assert extractions == []
+
+@pytest.fixture
+def fake_ffmpeg(monkeypatch):
+    """Replace ffmpeg with a script that writes a fixed mp3 body"""
+    script = 'import sys; sys.stdout.buffer.write(b"ID3fake")'
+    monkeypatch.setattr(app, 'FFMPEG_BASE_ARGS', (sys.executable, '-c', script))
+
+
+def test_transcode_releases_its_stream_slot(client, fake_ffmpeg, monkeypatch):
+    monkeypatch.setattr(app, 'stream_slots', threading.BoundedSemaphore(1))
+    app.stream_url_cache['fJ9rUzIMcZQ', 'audio'] = ('https://rr1.googlevideo.com/251', {})
+    
+    for path in ('/stream/mp3?url=fJ9rUzIMcZQ', '/stream?url=fJ9rUzIMcZQ&type=audio'):
+        response = client.get(path)
+        assert response.status_code == 200
+        assert response.data == b'ID3fake'
+        response.close()
+
+
+def test_transcode_returns_503_when_all_slots_are_busy(client, fake_ffmpeg, monkeypatch):
+    slots = threading.BoundedSemaphore(1)
+    slots.acquire()
+    monkeypatch.setattr(app, 'stream_slots', slots)
+    monkeypatch.setattr(app, 'STREAM_SLOT_TIMEOUT', 0.01)
+    
+    response = client.get('/stream/mp3?url=fJ9rUzIMcZQ')
+    
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == str(app.STREAM_RETRY_AFTER)
+    assert response.json == {'error': 'Server busy, try again later'}